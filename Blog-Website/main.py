@@ -1,15 +1,25 @@
+import hashlib
+import hmac
 import os
+import queue
+import signal
 import smtplib
+import threading
+from collections import OrderedDict
 from datetime import date
 from functools import wraps
 
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
+from flask import Flask, render_template, redirect, url_for, flash, abort, request
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
-from flask_gravatar import Gravatar
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import lambda_stmt, bindparam, false
 from sqlalchemy.exc import NoResultFound, IntegrityError
+from sqlalchemy.orm import selectinload, joinedload, lazyload, raiseload
+from sqlalchemy.schema import CreateIndex
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm, CreateContactForm
@@ -17,18 +27,46 @@ from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm, CreateCo
 MY_EMAIL = os.getenv("EMAIL")
 MY_PASSWORD = os.getenv("PASSWORD")
 
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", 2))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", 65536))
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", 1))
+
+password_hasher = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST,
+                                 parallelism=ARGON2_PARALLELISM)
+
+# Checked against when the login email is unknown, see login()
+_DUMMY_HASH = password_hasher.hash("x")
+# Same cost as the werkzeug hashes of accounts registered before argon2, see check_password()
+_DUMMY_LEGACY_HASH = generate_password_hash("x", method="pbkdf2:sha256:260000")
+
+USE_VERIFY_PASSWORD_CACHE = os.getenv("USE_VERIFY_PASSWORD_CACHE") == "1"
+VERIFY_PASSWORD_CACHE_SIZE = 4096
+
+POSTS_PER_PAGE = 20
+MAX_PAGE = 10000
+
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Check pooled connections with a cheap ping before use and recycle them before the server's idle timeout drops them
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_pre_ping": True,
+    "pool_recycle": 280,
+}
+# Only QueuePool takes sizing arguments, and SQLite URLs may get a StaticPool that rejects them
+if not (app.config['SQLALCHEMY_DATABASE_URI'] or "").startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+    )
 
 Bootstrap(app)
-db = SQLAlchemy(app)
+# Every view redirects or renders straight after committing, so reloading expired rows only costs SELECTs
+db = SQLAlchemy(app, session_options={"expire_on_commit": False})
 ckeditor = CKEditor(app)
 login_manager = LoginManager(app)
-gravatar = Gravatar(app, size=100, rating='g', default='retro', force_default=False, force_lower=False, use_ssl=False,
-                    base_url=None)
 
 
 class User(db.Model, UserMixin):
@@ -37,63 +75,239 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(250), unique=True, nullable=False)
     password = db.Column(db.String(250), nullable=False)
     name = db.Column(db.String(250), nullable=False)
+    is_admin = db.Column(db.Boolean, default=False, nullable=False, server_default=false())
+    gravatar_hash = db.Column(db.String(32), nullable=False)
 
-    posts = db.relationship("BlogPost", backref="users")
-    comments = db.relationship("Comment", backref="users")
+    posts = db.relationship("BlogPost", back_populates="author")
+    comments = db.relationship("Comment", back_populates="users")
 
 
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
     id = db.Column(db.Integer, primary_key=True)
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
 
-    comments = db.relationship("Comment", backref="blog_posts")
+    author = db.relationship("User", back_populates="posts")
+    comments = db.relationship("Comment", back_populates="blog_posts", lazy="selectin")
 
 
 class Comment(db.Model):
     __tablename__ = "comments"
     id = db.Column(db.Integer, primary_key=True)
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     text = db.Column(db.Text, nullable=False)
 
+    users = db.relationship("User", back_populates="comments", lazy="selectin")
+    blog_posts = db.relationship("BlogPost", back_populates="comments")
+
 
 with app.app_context():
     db.create_all()
+    # create_all() skips tables that already exist, so add indexes missing from older databases.
+    # IF NOT EXISTS keeps workers booting side by side from failing on an index another one just made.
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+    # Checked once at startup. Accounts only ever move from pbkdf2 to argon2, so a stale True just
+    # keeps the padding in check_password() a little longer than needed
+    _legacy_hashes_present = db.session.execute(
+        db.select(User.id).where(User.password.not_like("$argon2%")).limit(1)
+    ).first() is not None
+
+# Built and cache-keyed once; primary-key lookups use db.session.get() instead
+_user_by_email = lambda_stmt(lambda: db.select(User).filter_by(email=bindparam("email")))
+
+
+# Successful password checks: stored hash -> HMAC of the password that matched it, so the plain
+# password is never kept in memory and a password change invalidates its entry. The stored hash
+# embeds a per-user salt, so one cache is safely shared by every user.
+_verify_cache = OrderedDict()
+_verify_cache_lock = threading.RLock()  # re-entrant, as the SIGHUP handler may run while it is held
+
+
+def clear_verify_cache(*_):
+    with _verify_cache_lock:
+        _verify_cache.clear()
+
+
+# SIGHUP empties the cache, so every login goes through the full KDF again without a restart
+if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGHUP, clear_verify_cache)
+
+
+def _check_argon2(stored_hash, password):
+    try:
+        return password_hasher.verify(stored_hash, password)
+    except (VerificationError, InvalidHash):
+        return False
+
+
+def check_password(stored_hash, password):
+    # Accounts registered before the switch to argon2 still carry werkzeug pbkdf2 hashes
+    legacy = not stored_hash.startswith("$argon2")
+    if legacy:
+        result = check_password_hash(stored_hash, password)
+    else:
+        result = _check_argon2(stored_hash, password)
+
+    # While any pbkdf2 hash is left, every check runs one pbkdf2 and one argon2 verification, so a
+    # wrong password costs the same for either kind of account and for an unknown email
+    if _legacy_hashes_present:
+        if legacy:
+            _check_argon2(_DUMMY_HASH, password)
+        else:
+            check_password_hash(_DUMMY_LEGACY_HASH, password)
+
+    return result
+
+
+def needs_rehash(stored_hash):
+    return not stored_hash.startswith("$argon2") or password_hasher.check_needs_rehash(stored_hash)
+
+
+def verify_password(stored_hash, password):
+    if not USE_VERIFY_PASSWORD_CACHE:
+        return check_password(stored_hash, password)
+
+    digest = hmac.new(app.config['SECRET_KEY'].encode(), password.encode(), "sha256").digest()
+    with _verify_cache_lock:
+        cached = _verify_cache.pop(stored_hash, None)
+        if cached is not None:
+            _verify_cache[stored_hash] = cached
+
+    # Secrets derived from user input are only ever compared with hmac.compare_digest, never ==
+    if cached is not None and hmac.compare_digest(cached, digest):
+        return True
+
+    if not check_password(stored_hash, password):
+        return False
+
+    with _verify_cache_lock:
+        _verify_cache[stored_hash] = digest
+        if len(_verify_cache) > VERIFY_PASSWORD_CACHE_SIZE:
+            _verify_cache.popitem(last=False)
+    return True
+
+
+# In debug mode any relationship a view didn't ask to load raises instead of
+# quietly issuing one lazy SELECT per row while the template renders
+def loader_options(*options):
+    if app.debug:
+        return [*options, raiseload("*")]
+    return list(options)
+
+
+# One logged-in SMTP connection per thread, reused across contact messages
+_smtp = threading.local()
+
+
+def close_smtp_connection():
+    connection = getattr(_smtp, "connection", None)
+    _smtp.connection = None
+    if connection is not None:
+        try:
+            connection.close()
+        except OSError:
+            pass
+
+
+def smtp_connection():
+    connection = getattr(_smtp, "connection", None)
+    if connection is not None:
+        try:
+            connection.noop()
+            return connection
+        except (smtplib.SMTPException, OSError):
+            close_smtp_connection()
+
+    connection = smtplib.SMTP("smtp.gmail.com", port=587)
+    connection.starttls()
+    connection.login(MY_EMAIL, MY_PASSWORD)
+    _smtp.connection = connection
+    return connection
+
+
+def send_email(name, email, phone, message):
+    msg = f"subject:New Message\n\nName: {name}\nEmail: {email}\nPhone: {phone}\nMessage: {message}".encode("utf-8")
+    try:
+        smtp_connection().sendmail(from_addr=MY_EMAIL, to_addrs=MY_EMAIL, msg=msg)
+    except smtplib.SMTPServerDisconnected:
+        # The server may drop us between the NOOP and the send, retry once on a fresh connection
+        close_smtp_connection()
+        smtp_connection().sendmail(from_addr=MY_EMAIL, to_addrs=MY_EMAIL, msg=msg)
+
+
+# Contact messages are sent by a background thread so the request never waits on SMTP
+_mail_queue = queue.Queue()
+_mail_thread = None
+_mail_thread_lock = threading.Lock()
+
+
+def _smtp_worker():
+    while True:
+        data = _mail_queue.get()
+        try:
+            send_email(**data)
+        except Exception:
+            # Never let one bad message stop the thread, or every later message would be dropped
+            close_smtp_connection()
+            app.logger.exception("Could not send the contact message")
+        finally:
+            _mail_queue.task_done()
+
+
+def queue_email(data):
+    global _mail_thread
+    # Started on first use rather than at import, so every forked worker (e.g. gunicorn --preload) gets its own
+    with _mail_thread_lock:
+        if _mail_thread is None or not _mail_thread.is_alive():
+            _mail_thread = threading.Thread(target=_smtp_worker, daemon=True)
+            _mail_thread.start()
+    _mail_queue.put(data)
 
 
 # Python Decorator function for admin verification
 def admin_only(function):
     @wraps(function)
     def wrapper(*args, **kwargs):
-        try:
-            if current_user.id == 1:
-                return function(*args, **kwargs)
-            else:
-                return abort(403)
-        except AttributeError:
+        if not current_user.is_authenticated or not current_user.is_admin:
             return abort(403)
+        return function(*args, **kwargs)
 
     return wrapper
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    try:
-        return db.session.execute(db.select(User).filter_by(id=user_id)).scalar_one()
-    except NoResultFound:
-        return None
+    return db.session.get(User, int(user_id))
 
 
 @app.route('/')
 def get_all_posts():
-    posts = db.session.execute(db.select(BlogPost)).scalars()
-    return render_template("index.html", all_posts=posts)
+    page = max(request.args.get("page", 1, type=int), 1)
+    # Keeps the OFFSET within what the database accepts, however large a number is asked for
+    if page > MAX_PAGE:
+        abort(404)
+    # One extra row tells us whether an older page exists without a COUNT query
+    posts = db.session.execute(
+        db.select(BlogPost)
+        .options(*loader_options(joinedload(BlogPost.author), lazyload(BlogPost.comments)))
+        .order_by(BlogPost.id.desc())
+        .limit(POSTS_PER_PAGE + 1)
+        .offset((page - 1) * POSTS_PER_PAGE)
+    ).scalars().all()
+    if page > 1 and not posts:
+        abort(404)
+    return render_template("index.html", all_posts=posts[:POSTS_PER_PAGE], page=page,
+                           has_next=len(posts) > POSTS_PER_PAGE)
 
 
 @app.route('/register', methods=["GET", "POST"])
@@ -102,12 +316,17 @@ def register():
 
     if form.validate_on_submit():
         email = form.email.data
-        password = generate_password_hash(form.password.data)
+        password = password_hasher.hash(form.password.data)
         name = form.name.data
-
+        # Hashed once here so templates can build the Gravatar URL without hashing per comment
+        gravatar_hash = hashlib.md5(email.strip().lower().encode()).hexdigest()
         try:
-            new_user = User(email=email, password=password, name=name)  # type: ignore
+            new_user = User(email=email, password=password, name=name,
+                            gravatar_hash=gravatar_hash)  # type: ignore
             db.session.add(new_user)
+            db.session.flush()
+            # User 1 administers the blog; decided from the inserted id so concurrent sign-ups can't both qualify
+            new_user.is_admin = new_user.id == 1
             db.session.commit()
         except IntegrityError:
             flash("The Email you have entered has been taken, try to use a different Email!")
@@ -128,17 +347,20 @@ def login():
         password = form.password.data
 
         try:
-            user = db.session.execute(db.select(User).filter_by(email=email)).scalar_one()
+            user = db.session.execute(_user_by_email, {"email": email}).scalar_one()
         except NoResultFound:
-            flash("Sorry, Wrong Email, Try to use a different Email!")
-            return redirect(url_for("login"))
+            # Hash anyway, so an unknown email takes as long as a wrong password
+            check_password(_DUMMY_HASH, password)
         else:
-            if check_password_hash(user.password, password):
+            if verify_password(user.password, password):
+                if needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
+                    db.session.commit()
                 login_user(user)
                 return redirect(url_for('get_all_posts'))
-            else:
-                flash("Sorry, Wrong Password, Try to use a different Password!")
-                return redirect(url_for("login"))
+
+        flash("Invalid email or password!")
+        return redirect(url_for("login"))
 
     return render_template("login.html", form=form)
 
@@ -149,7 +371,7 @@ def logout():
     return redirect(url_for('get_all_posts'))
 
 
-@app.route("/post/<post_id>", methods=["GET", "POST"])
+@app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
     form = CommentForm()
 
@@ -162,7 +384,12 @@ def show_post(post_id):
             flash("Please Login or Register to Submit your Comment!")
             return redirect(url_for("login"))
 
-    requested_post = db.session.execute(db.select(BlogPost).filter_by(id=post_id)).scalar_one()
+    requested_post = db.session.get(BlogPost, post_id, options=loader_options(
+        joinedload(BlogPost.author),
+        selectinload(BlogPost.comments).selectinload(Comment.users),
+    ))
+    if requested_post is None:
+        abort(404)
 
     return render_template("post.html", post=requested_post, form=form)
 
@@ -183,16 +410,8 @@ def contact():
         phone = data["phone"]
         message = data["message"]
 
-        try:
-            with smtplib.SMTP("smtp.gmail.com", port=587) as connection:
-                connection.starttls()
-                connection.login(MY_EMAIL, MY_PASSWORD)
-                connection.sendmail(from_addr=MY_EMAIL,
-                                    to_addrs=MY_EMAIL,
-                                    msg=f"subject:New Message\n\nName: {name}\nEmail: {email}\nPhone: {phone}\n"
-                                        f"Message: {message}".encode("utf-8"))
-        except smtplib.SMTPAuthenticationError:
-            return render_template("contact.html", form=form, h1="Successfully Send Your Message")
+        queue_email({"name": name, "email": email, "phone": phone, "message": message})
+        return render_template("contact.html", form=form, h1="Successfully Send Your Message")
 
     else:
         return render_template("contact.html", form=form, h1="Contact Me")
@@ -208,8 +427,7 @@ def add_new_post():
             author_id=current_user.id,
             subtitle=form.subtitle.data,
             body=form.body.data,
-            img_url=form.img_url.data,
-            date=date.today().strftime("%B %d, %Y")
+            img_url=form.img_url.data
         )
         db.session.add(new_post)
         db.session.commit()
@@ -219,10 +437,13 @@ def add_new_post():
     return render_template("make-post.html", form=form)
 
 
-@app.route("/edit-post/<post_id>", methods=["GET", "POST"])
+@app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
 def edit_post(post_id):
-    post = db.session.execute(db.select(BlogPost).filter_by(id=post_id)).scalar_one()
+    # The edit form never shows comments, so skip their default selectin load
+    post = db.session.get(BlogPost, post_id, options=[lazyload(BlogPost.comments)])
+    if post is None:
+        abort(404)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -241,10 +462,12 @@ def edit_post(post_id):
     return render_template("make-post.html", form=edit_form, goal="edit")
 
 
-@app.route("/delete/<post_id>")
+@app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = db.session.execute(db.select(BlogPost).filter_by(id=post_id)).scalar_one()
+    post_to_delete = db.session.get(BlogPost, post_id)
+    if post_to_delete is None:
+        abort(404)
     db.session.delete(post_to_delete)
     db.session.commit()
     return redirect(url_for('get_all_posts'))